@@ -1,11 +1,21 @@
 import sys
 import os
+import csv
 import platform
+import pickle
 from pydot import graph_from_dot_file
 import random
+from array import array
+from collections import defaultdict, deque
+from functools import reduce
+from itertools import islice
+from operator import or_
 
 DATASET = 'countries.csv'
 
+# Bump whenever the layout of the cached graph changes
+GRAPH_CACHE_VERSION = 1
+
 GRAPHS_PATH = "graphs/"
 if not os.path.exists(GRAPHS_PATH):
     os.mkdir(GRAPHS_PATH)
@@ -22,190 +32,328 @@ def parse(file_name):
               in each line and the values are the remaining elements in each line.
     """
 
-    with open(file_name, 'r') as f:
-        lines = f.readlines()
-        lines = [line.strip().split(',') for line in lines]
-    return {line[0]: line[1:] for line in lines}
+    with open(file_name, 'r', newline='') as f:
+        return {row[0]: row[1:] for row in csv.reader(f) if row}
 
 
-def bfs(graph, source, target):
+def load_graph(file_name):
     """
-    Perform a breadth-first search on a graph to find the shortest path from a source node to a target node.
+    Parses a dataset and converts it to CSR form, reusing the cache stored next to it when it is up to date.
+
+    The structure of the graph is validated when the cache is built, so that later runs can skip the check.
+
+    Parameters:
+        file_name (str): The path to the dataset.
+
+    Returns:
+        tuple: A tuple containing the graph as returned by parse, its CSR form as returned by to_csr
+               and whether the structure of the graph is valid.
+    """
+
+    cache_name = os.path.splitext(file_name)[0] + ".cache.pkl"
+    stat = os.stat(file_name)
+    stamp = (GRAPH_CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+
+    try:
+        with open(cache_name, 'rb') as f:
+            cached_stamp, graph, csr, validated = pickle.load(f)
+        if cached_stamp == stamp:
+            return graph, csr, validated
+    except Exception:
+        # Any unreadable or malformed cache is rebuilt
+        pass
+
+    graph = parse(file_name)
+    csr = to_csr(graph)
+    validated = not validate_graph(graph)
+
+    try:
+        with open(cache_name, 'wb') as f:
+            pickle.dump((stamp, graph, csr, validated), f, pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass
+
+    return graph, csr, validated
+
+
+def to_csr(graph):
+    """
+    Convert a graph into a compressed sparse row (CSR) representation with integer node IDs.
 
     Parameters:
         graph (dict): The graph represented as a dictionary where the keys are nodes and the values are lists of neighboring nodes.
-        source: The source node from which to start the search.
-        target: The target node to find the shortest path to.
 
     Returns:
-        tuple: A tuple containing the shortest path as a list of nodes and the length of the path as an integer. If no path is found, the path will be None and the length will be -1.
+        tuple: A tuple (names, ids, indptr, indices, masks) where names maps IDs to nodes, ids maps nodes to IDs,
+               the neighbors of node i are indices[indptr[i]:indptr[i+1]] and masks[i] is their bitmask.
     """
 
-    if source == target:
-        return [], 0
+    names = list(graph)
+    ids = {name: i for i, name in enumerate(names)}
 
-    visited = set()
-    queue = [source]
-    current = source
+    indptr = array('i', [0])
+    indices = array('i')
+    for name in names:
+        # Unknown neighbors are skipped here and reported by validate_graph
+        indices.extend(ids[neighbor] for neighbor in graph[name] if neighbor in ids)
+        indptr.append(len(indices))
 
-    parent_map = {source: None}
+    return names, ids, indptr, indices, to_bitsets(indptr, indices)
 
-    while current != target:
 
-        current = queue.pop(0)
+def to_bitsets(indptr, indices):
+    """
+    Convert a CSR graph into neighbor bitmasks.
+
+    Parameters:
+        indptr (array): The CSR row offsets.
+        indices (array): The CSR neighbor IDs.
 
-        visited.add(current)
+    Returns:
+        tuple: A tuple of integers where bit j of the i-th mask is set if j is a neighbor of i.
+    """
 
-        unvisitedNeighbors = [
-            neighbor for neighbor in graph[current] if neighbor not in visited]
+    masks = []
+    for i in range(len(indptr) - 1):
+        mask = 0
+        for j in indices[indptr[i]:indptr[i + 1]]:
+            mask |= 1 << j
+        masks.append(mask)
+    return tuple(masks)
 
-        for neighbor in unvisitedNeighbors:
-            if neighbor not in queue:
-                queue.append(neighbor)
-            if neighbor in parent_map:
-                parent_map[neighbor].append(current)
-            else:
-                parent_map[neighbor] = [current]
 
-    path = []
-    while current != source:
-        path.append(current)
-        current = parent_map[current][0]
-    minimum = len(path)
+def bits(mask):
+    """
+    Iterate over the set bits of a bitmask, lowest first.
+
+    Parameters:
+        mask (int): The bitmask.
+
+    Returns:
+        generator: The indices of the set bits.
+    """
+
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def bfs_bitset(masks, source, target):
+    """
+    Bidirectional breadth-first search kernel working on neighbor bitmasks.
+
+    Parameters:
+        masks (tuple): The neighbor bitmasks, as returned by to_bitsets.
+        source (int): The source node ID.
+        target (int): The target node ID.
+
+    Returns:
+        tuple: The frontier bitmasks of each level grown from the source and from the target, forward[k] holding
+               the nodes at distance k from the source and backward[k] the nodes at distance k from the target.
+               The search stops as soon as the two last frontiers meet, or when a frontier runs empty if the target cannot be reached.
+    """
+
+    sides = ([1 << source], [1 << target])
+    visited = [1 << source, 1 << target]
+
+    while not sides[0][-1] & sides[1][-1]:
+
+        # Expand the smaller frontier
+        side = 0 if bin(sides[0][-1]).count('1') <= bin(sides[1][-1]).count('1') else 1
 
-    paths = get_paths(source, target, parent_map, minimum)
-    return paths if paths else [], minimum
+        next_mask = 0
+        for i in bits(sides[side][-1]):
+            next_mask |= masks[i]
+        frontier = next_mask & ~visited[side]
+        if not frontier:
+            break
 
+        sides[side].append(frontier)
+        visited[side] |= frontier
 
-def get_paths(source, target, parent_map, minimum):
+    return sides
+
+
+def shortest_paths(masks, source, target):
     """
-    Retrieve all paths from the given node using the provided path dictionary.
+    Find all shortest paths between two node IDs.
 
     Parameters:
-        node: The starting node.
-        path_dict: A dictionary containing the paths.
+        masks (tuple): The neighbor bitmasks, as returned by to_bitsets.
+        source (int): The source node ID.
+        target (int): The target node ID.
 
     Returns:
-        A list of all paths from the given node.
+        tuple: A tuple containing the shortest paths as tuples of node IDs, from the source to the target included,
+               and the length of the paths. If no path is found, the paths will be empty and the length will be -1.
     """
 
+    if source == target:
+        return [(source,)], 0
+
+    forward, backward = bfs_bitset(masks, source, target)
+    meet = forward[-1] & backward[-1]
+    if not meet:
+        return [], -1
+    minimum = len(forward) + len(backward) - 2
+
+    parent_map = {source: None}
+
+    # Walk back to the source, the parents of a node are its neighbors on the previous forward level
+    layer = meet
+    for level in reversed(forward[:-1]):
+        previous = 0
+        for v in bits(layer):
+            parents = masks[v] & level
+            parent_map[v] = list(bits(parents))
+            previous |= parents
+        layer = previous
+
+    # Walk on to the target, the children of a node are its neighbors on the next backward level
+    layer = meet
+    for level in reversed(backward[:-1]):
+        following = 0
+        for u in bits(layer):
+            following |= masks[u] & level
+        for w in bits(following):
+            parent_map[w] = list(bits(masks[w] & layer))
+        layer = following
+
     paths = []
-    get_paths_aux(paths, [], source, target, parent_map, minimum)
-    paths.sort()
-    return paths
+    get_paths_aux(paths, target, parent_map)
+    return [(source, *path) for path in paths], minimum
 
 
-def get_paths_aux(paths, path, source, node, parent_map, minimum):
+def bfs(csr, source, target):
     """
-    Recursively finds all paths from a given node to its parent nodes in a path dictionary.
+    Perform a breadth-first search on a graph to find the shortest path from a source node to a target node.
 
     Parameters:
-        paths (list): A list to store the found paths.
-        path (list): The current path being constructed.
-        node: The current node being processed.
-        path_dict (dict): A dictionary that maps each node to its parent nodes.
+        csr (tuple): The graph in CSR form, as returned by to_csr.
+        source: The source node from which to start the search.
+        target: The target node to find the shortest path to.
 
     Returns:
-        None
+        tuple: A tuple containing the shortest paths as lists of nodes and the length of the path as an integer. If no path is found, the paths will be empty and the length will be -1.
     """
 
-    if len(path) > minimum:
-        return
+    if source == target:
+        return [], 0
 
-    if parent_map[node] == None:
-        path.reverse()
-        paths.append(path)
-        return
+    names, ids, _, _, masks = csr
 
-    new_path = path.copy()
-    new_path.append(node)
-    for parent in parent_map[node]:
-        get_paths_aux(paths, new_path, source, parent, parent_map, minimum)
+    id_paths, minimum = shortest_paths(masks, ids[source], ids[target])
+    if minimum < 0:
+        return [], -1
+
+    paths = [[names[v] for v in path[1:]] for path in id_paths]
+    paths.sort()
+    return paths, minimum
 
 
-def check_adjacency(graph):
+def get_paths_aux(paths, node, parent_map):
     """
-    Check the adjacency of nodes in a graph.
+    Iteratively finds all paths from a given node to the root of a path dictionary.
 
     Parameters:
-        graph (dict): A dictionary representing the graph, where the keys are nodes and the values are lists of neighbors.
+        paths (list): A list to store the found paths.
+        node: The node the paths start from.
+        parent_map (dict): A dictionary that maps each node to its parent nodes, the root being mapped to None.
 
     Returns:
-        True if an error occured, False otherwise.
+        None
     """
 
-    for node, neighbors in graph.items():
-        for neighbor in neighbors:
-            if neighbor not in graph:
-                print(f"{neighbor} is not a key but exists as value.")
-                return True
-            if node not in graph[neighbor]:
-                print(f"{node} has {neighbor} as neighbor but {neighbor} does not have {node} as neighbor.")
-                return True
-    return False
+    # A single path is shared by the whole walk, stack[i] iterates over the parents of path[i]
+    path = [node]
+    stack = [iter(parent_map[node])]
+
+    while stack:
+        parent = next(stack[-1], None)
 
+        if parent is None:
+            stack.pop()
+            path.pop()
+            continue
+
+        if parent_map[parent] is None:
+            paths.append(path[::-1])
+            continue
 
-def check_connectedness(graph):
+        path.append(parent)
+        stack.append(iter(parent_map[parent]))
+
+
+def validate_graph(graph, source=None, target=None, structure=True):
     """
-    Check if a graph is connected.
+    Check that the source and target inputs are valid entries in the graph, that every neighbor relation
+    is symmetric and that the graph is connected, in a single traversal.
 
     Parameters:
         graph (dict): A dictionary representing the graph, where the keys are the nodes and the values are lists of neighbors.
+        source (str, optional): The source input to be checked, if any.
+        target (str, optional): The target input to be checked, if any.
+        structure (bool, optional): Whether to check the symmetry and connectedness of the graph. Defaults to True.
 
     Returns:
-        True if an error occured, False otherwise.
+        list: The error messages, empty if the graph is valid.
     """
 
-    visited = []
-    queue = [next(iter(graph))]
+    errors = []
 
-    while queue:
+    if source is not None and source not in graph:
+        errors.append(f"{source} is not a valid source input.")
+    if target is not None and target not in graph:
+        errors.append(f"{target} is not a valid target input.")
 
-        current = queue.pop(0)
-        visited.append(current)
+    if not structure:
+        return errors
 
-        unvisitedNeighbors = [
-            neighbor for neighbor in graph[current] if neighbor not in visited]
+    neighbor_sets = {node: set(neighbors) for node, neighbors in graph.items()}
 
-        for neighbor in unvisitedNeighbors:
-            if neighbor not in queue:
+    def check_neighbors(node):
+        for neighbor in neighbor_sets[node]:
+            if neighbor not in neighbor_sets:
+                errors.append(f"{neighbor} is not a key but exists as value.")
+            elif node not in neighbor_sets[neighbor]:
+                errors.append(f"{node} has {neighbor} as neighbor but {neighbor} does not have {node} as neighbor.")
+
+    # Breadth-first search from any node, checking the neighbors of each node reached
+    queue = deque(islice(graph, 1))
+    visited = set(queue)
+    while queue:
+        current = queue.popleft()
+        check_neighbors(current)
+        for neighbor in neighbor_sets[current]:
+            if neighbor in neighbor_sets and neighbor not in visited:
+                visited.add(neighbor)
                 queue.append(neighbor)
 
     disconnected = [node for node in graph if node not in visited]
+    for node in disconnected:
+        check_neighbors(node)
+    if disconnected:
+        errors.append(f"Graph is not connected, isolated nodes: {disconnected}.")
 
-    if len(visited) < len(graph):
-        print(f"Graph is not connected, isolated nodes: {disconnected}.")
-        return True
-    return False
+    return errors
 
 
-def check_entries(graph, source, target):
+def check_graph(graph, source, target, validated=False):
     """
-    Check if the source and target inputs are valid entries in the graph.
+    Validate the graph and the inputs, exiting with the usage message if an error occured.
 
     Parameters:
         graph (dict): A dictionary representing the graph.
         source (str): The source input to be checked.
         target (str): The target input to be checked.
-
-    Returns:
-        True if an error occured, False otherwise.
+        validated (bool, optional): Whether the structure of the graph is already known to be valid, as returned by load_graph.
     """
 
-    if source not in graph:
-        print(f"{source} is not a valid source input.")
-        return True
-    if target not in graph:
-        print(f"{target} is not a valid target input.")
-        return True
-    return False
-
-
-def check_graph(graph, source, target):
-    error = check_entries(graph, source, target) or \
-        check_adjacency(graph) or \
-        check_connectedness(graph)
-    if error:
+    errors = validate_graph(graph, source, target, structure=not validated)
+    for error in errors:
+        print(error)
+    if errors:
         usage()
 
 
@@ -246,42 +394,33 @@ def to_subgraph(source, paths, num_paths=None, underscores=False):
         dict: A dictionary representing the subgraph, where the keys are nodes and the values are lists of adjacent nodes.
     """
 
-    subgraph = {}
+    # Neighbors are stored as dict keys, a set that keeps the insertion order
+    adjacency = defaultdict(dict)
 
     if not num_paths:
         num_paths = len(paths)
+    selected = paths[:min(len(paths), num_paths)]
+
+    # Escape each node name once, however many paths it appears in
+    escape = (lambda name: name.replace(' ', '_')) if underscores else (lambda name: name)
+    escaped = {node: escape(node) for node in set().union(*selected)}
+    source = escape(source)
 
-    for path in paths[:min(len(paths), num_paths)]:
+    for path in selected:
         if not path:
             continue
 
-        source = source.replace(' ', '_') if underscores else source
-        path_0 = path[0].replace(' ', '_') if underscores else path[0]
-
-        if source not in subgraph:
-            subgraph[source] = [path_0]
-        else:
-            if path_0 not in subgraph[source]:
-                subgraph[source].append(path_0)
+        adjacency[source][escaped[path[0]]] = None
 
         for i in range(len(path)-1):
+            adjacency[escaped[path[i]]][escaped[path[i+1]]] = None
 
-            path_i = path[i].replace(' ', '_') if underscores else path[i]
-            path_ii = path[i+1].replace(' ', '_') if underscores else path[i+1]
-
-            if path_i not in subgraph:
-                subgraph[path_i] = [path_ii]
-            else:
-                if path_ii not in subgraph[path_i]:
-                    subgraph[path_i].append(path_ii)
+    subgraph = {node: list(neighbors) for node, neighbors in adjacency.items()}
 
     if not paths:
-        source = source.replace(' ', '_') if underscores else source
         subgraph[source] = []
     else:
-        target = paths[0][-1].replace(' ',
-                                      '_') if underscores else paths[0][-1]
-        subgraph[target] = []
+        subgraph[escape(paths[0][-1])] = []
 
     return subgraph
 
@@ -299,34 +438,29 @@ def to_dot(source, paths, num_paths=None, png=True, svg=True):
 
     subgraph = to_subgraph(source, paths, num_paths, underscores=True)
 
-    with open(GRAPHS_PATH + "graph.dot", 'w') as f:
-
-        # Open Graph
-        f.write("digraph G {\n")
-        f.write("\trankdir=LR;\n")
-        f.write("\n")
-
-        # Write countries
-        for country in subgraph:
-            f.write(f"\t{country};\n")
-
-        # Write edges
-        if subgraph:
-            f.write("\n")
-            for country in subgraph:
-                for neighbor in subgraph[country]:
-                    f.write(f"\t{country} -> {neighbor};\n")
-
-        # Write labels
-        no_labels = True
-        for country in subgraph:
-            if '_' in country:
-                if no_labels:
-                    f.write("\n")
-                    no_labels = False
-                fCountry = country.replace('_', '\\n')
-                f.write(f"\t{country} [label=\"{fCountry}\"];\n")
-        f.write("}")
+    # Open Graph
+    parts = ["digraph G {\n", "\trankdir=LR;\n", "\n"]
+
+    # Write countries and edges, each block or edge list being emitted by a single join
+    if subgraph:
+        parts.append("\t" + ";\n\t".join(subgraph) + ";\n")
+        parts.append("\n")
+        for country, neighbors in subgraph.items():
+            if neighbors:
+                prefix = "\t" + country + " -> "
+                parts.append(prefix + (";\n" + prefix).join(neighbors) + ";\n")
+
+    # Write labels
+    labels = [country for country in subgraph if '_' in country]
+    if labels:
+        parts.append("\n")
+        for country in labels:
+            fCountry = country.replace('_', '\\n')
+            parts.append(f"\t{country} [label=\"{fCountry}\"];\n")
+    parts.append("}")
+
+    with open(GRAPHS_PATH + "graph.dot", 'w', buffering=1 << 16) as f:
+        f.write("".join(parts))
 
     if png:
         (graph,) = graph_from_dot_file(GRAPHS_PATH + "graph.dot")
@@ -343,13 +477,13 @@ def search():
         print("Invalid number of parameters.")
         usage()
 
-    countries = parse(DATASET)
+    countries, csr, validated = load_graph(DATASET)
     source = sys.argv[2].replace('_', ' ')
     target = sys.argv[3].replace('_', ' ')
 
-    check_graph(countries, source, target)
+    check_graph(countries, source, target, validated)
 
-    paths, length = bfs(countries, source, target)
+    paths, length = bfs(csr, source, target)
 
     nb_paths = len(paths)
     if len(sys.argv) == 5:
@@ -370,11 +504,10 @@ def search():
     os.system(f"{display_command} {GRAPHS_PATH}graph.svg")
 
 
-def get_remaining_paths(paths, guesses):
+def get_remaining_paths(paths, path_masks, guess_mask):
     remaining_paths = []
-    for path in paths:
-        path_set = set(path)
-        if guesses.issubset(path_set):
+    for path, path_mask in zip(paths, path_masks):
+        if not guess_mask & ~path_mask:
             remaining_paths.append(path)
     return remaining_paths
 
@@ -404,33 +537,41 @@ def game():
     max_mistakes = 3
     nb_mistakes = 0
 
-    countries = parse(DATASET)
+    countries, csr, validated = load_graph(DATASET)
 
     source = random.choice(list(countries.keys()))
-    target = source
-    while target == source or target in countries[source]:
-        target = random.choice(list(countries.keys()))
+    excluded = set(countries[source])
+    excluded.add(source)
+    target = random.choice([country for country in countries if country not in excluded])
 
-    check_graph(countries, source, target)
+    check_graph(countries, source, target, validated)
 
-    paths, _ = bfs(countries, source, target)
+    paths, _ = bfs(csr, source, target)
     remaining_paths = paths.copy()
 
     for path in paths:
         path.pop(-1)
 
+    # Bitmasks of the countries on each path, a guess is right if its bits are a subset of a path's
+    ids = csr[1]
+    path_masks = [sum(1 << ids[node] for node in path) for path in paths]
+    on_path_mask = reduce(or_, path_masks, 0)
+
     guesses = set()
+    guess_mask = 0
 
     print(f"Find the shortest path from {source} to {target}")
 
     while nb_mistakes < max_mistakes:
         guess = input("Enter country name: ")
         guesses.add(guess)
+        guess_bit = 1 << ids[guess] if guess in ids else 0
+        guess_mask |= guess_bit
 
         # Target reached
-        for path in paths:
+        for path, path_mask in zip(paths, path_masks):
             if len(path) == len(guesses):
-                if set(path) == guesses:
+                if path_mask == guess_mask:
                     print_path(source, path + [target])
                     print(f"{target} reached with {nb_mistakes} mistake{'s' if nb_mistakes != 1 else ''}")
                     return
@@ -443,12 +584,13 @@ def game():
 
         # Right guess
         subset_flag = False
-        for path in paths:
-            if guesses.issubset(path):
-                subset_flag = True
-                remaining_paths = get_remaining_paths(remaining_paths, guesses)
-                print_incomplete_path(remaining_paths[0], guesses)
-                break
+        if guess_bit & on_path_mask:
+            for path_mask in path_masks:
+                if not guess_mask & ~path_mask:
+                    subset_flag = True
+                    remaining_paths = get_remaining_paths(paths, path_masks, guess_mask)
+                    print_incomplete_path(remaining_paths[0], guesses)
+                    break
 
         # Wrong guess
         if not subset_flag:
@@ -456,6 +598,7 @@ def game():
             print(f"{guess.replace('_', ' ')} is not on one of the optimal paths")
             print(f"{nb_mistakes}/{max_mistakes} mistakes")
             guesses.remove(guess)
+            guess_mask &= ~guess_bit
 
             if nb_mistakes == max_mistakes:
                 print("Game over!")